@@ -31,7 +31,11 @@ def solve():
     values = body.get("values", {})
     size = int(body["size"])
 
-    csp = create_sudoku_csp(N=size, values=values)
+    try:
+        csp = create_sudoku_csp(N=size, values=values)
+    except ValueError as e:
+        print(e)
+        return "Invalid solution", 400
 
     try:
         csp.solve()
@@ -41,5 +45,5 @@ def solve():
     if len(csp.solutions) == 0:
         return "Invalid solution", 400
     else:
-        solution = csp.solutions[0]
+        solution = {str(pos): value for pos, value in csp.solutions[0].items()}
         return {"solved": values == solution, "values": solution}
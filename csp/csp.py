@@ -1,5 +1,10 @@
+import itertools
+import multiprocessing
+import os
 import pprint
+import queue
 import random
+import time
 from collections import defaultdict, deque
 from enum import Enum, auto
 from typing import *
@@ -12,6 +17,22 @@ D = TypeVar("D")
 Solution = Dict[V, D]
 Constraint = Callable[[Solution], bool]
 
+DomainMask = int
+
+UNASSIGNED = object()
+
+MAX_CACHED_READS = 16
+MAX_CACHE_SIZE = 1 << 16
+
+POLL_INTERVAL = 0.1
+
+
+def iter_bits(mask: DomainMask) -> Iterator[int]:
+    while mask:
+        lsb = mask & -mask
+        yield lsb.bit_length() - 1
+        mask ^= lsb
+
 
 class PruningType(Enum):
     FORWARD_CHECKING = auto()
@@ -25,174 +46,670 @@ class VariableOrdering(Enum):
     NO_ORDERING = auto()
 
 
+class ValueOrdering(Enum):
+    LEAST_CONSTRAINING = auto()
+    NO_ORDERING = auto()
+
+
 class CSP:
     def __init__(
         self,
         pruning_type: PruningType = PruningType.FORWARD_CHECKING,
         variable_ordering: VariableOrdering = VariableOrdering.NO_ORDERING,
         max_solutions: int = 1,
+        value_ordering: ValueOrdering = ValueOrdering.NO_ORDERING,
+        backjumping: bool = False,
     ):
-        self.pruning_type = pruning_type
         self.max_solutions = max_solutions
+        self.backjumping = backjumping
 
-        if pruning_type == PruningType.FORWARD_CHECKING:
-            self.pruning_function = self.forward_check
-        elif pruning_type == PruningType.AC3:
-            self.pruning_function = self.AC3
-        elif pruning_type == PruningType.AC_FC:
-            self.pruning_function = self.AC_FC
-        elif pruning_type == PruningType.NO_PRUNING:
-            self.pruning_function = lambda x, y: False
+        self.set_pruning_type(pruning_type)
 
         self.variable_ordering = variable_ordering
+        self.value_ordering = value_ordering
 
         self.variables: List[V] = []
         self.constraints: Dict[V, List[Constraint]] = defaultdict(list)
-        self.current_domains: Dict[V, List[D]] = {}
+        self.constraint_tuples: Dict[V, Tuple[Constraint, ...]] = {}
+        self.constraint_scopes: List[Tuple[Constraint, Tuple[V, ...]]] = []
+        self.constraint_keys: Set[Hashable] = set()
+        self.check_scopes: Dict[int, Tuple[V, ...]] = {}
+        self.binary_constraints: Dict[Tuple[V, V], List[Constraint]] = defaultdict(list)
+        self.supports: Dict[Tuple[V, V], List[DomainMask]] = {}
+        self.check_supports: Dict[Tuple[V, V], List[DomainMask]] = {}
+        self.constraint_reads: Dict[V, Tuple[V, ...]] = {}
+        self.valid_cache: Dict[Tuple[Any, ...], bool] = {}
+        self.current_domains: Dict[V, DomainMask] = {}
 
         self.domains: Dict[V, List[D]] = {}
-        self.cached_domains: Dict[str, List[D]] = {}
+        self.cached_domains: Dict[Tuple[Any, ...], List[D]] = {}
 
         self.variable_stack: Deque[V] = deque()
 
         self.neighbors: Dict[V, Set[V]] = defaultdict(set)
-        self.pruned_map: Dict[V, Dict[V, Set[D]]] = defaultdict(
-            lambda: defaultdict(set)
-        )
+        self.check_neighbors: Dict[V, Tuple[V, ...]] = {}
+        self.arcs: Dict[V, Tuple[Tuple[V, V], ...]] = {}
+        self.assign_hooks: Dict[V, Tuple[Constraint, ...]] = {}
+        self.all_different_groups: Dict[V, Tuple[Tuple[V, ...], ...]] = {}
+        self.domain_bits: Dict[V, Dict[D, DomainMask]] = {}
+        self.degrees: Optional[Dict[V, int]] = None
+        self.pruned_map: Dict[V, List[Tuple[V, DomainMask]]] = {}
+
+        self.root_masks: Dict[V, DomainMask] = {}
 
         self.solutions: List[Solution] = []
 
+    def set_pruning_type(self, pruning_type: PruningType):
+        self.pruning_type = pruning_type
+
+        if pruning_type == PruningType.FORWARD_CHECKING:
+            self.pruning_function = self.forward_check
+        elif pruning_type == PruningType.AC3:
+            self.pruning_function = self.AC3
+        elif pruning_type == PruningType.AC_FC:
+            self.pruning_function = self.AC_FC
+        elif pruning_type == PruningType.NO_PRUNING:
+            self.pruning_function = lambda x, y: True
+
     def add_variables(self, domain: List[D], *variables: V):
-        key = str(domain)
-        t_domain = (
-            list(domain) if key not in self.cached_domains else self.cached_domains[key]
-        )
+        try:
+            key = tuple((type(d), d) for d in domain)
+            t_domain = self.cached_domains.get(key)
+        except TypeError:
+            key = t_domain = None
+
+        if t_domain is None:
+            t_domain = domain if isinstance(domain, tuple) else list(domain)
+            if key is not None:
+                self.cached_domains[key] = t_domain
+
         for v in variables:
             self.variables.append(v)
             self.domains[v] = t_domain
 
+    def set_value(self, variable: V, value: D):
+        self.root_masks[variable] = sum(
+            1 << i for i, d in enumerate(self.domains[variable]) if d == value
+        )
+
     def add_constraint(self, constraint_pair: Tuple[Constraint, List[V]]):
         constraint, variables = constraint_pair
+
+        key = getattr(constraint, "key", None)
+        if key is not None:
+            if key in self.constraint_keys:
+                return
+            self.constraint_keys.add(key)
+
+        self.constraint_scopes.append((constraint, tuple(variables)))
+
         for v in variables:
             self.constraints[v].append(constraint)
             self.neighbors[v].update(variables)
             self.neighbors[v].remove(v)
 
+        if len(variables) == 2 and variables[0] != variables[1]:
+            p1, p2 = variables
+            self.binary_constraints[p1, p2].append(constraint)
+            self.binary_constraints[p2, p1].append(constraint)
+
+    def add_alldiff_batch(self, groups: Iterable[Iterable[V]]):
+        for group in groups:
+            self.add_constraint(all_different_constraint(*group))
+
+    def finalize(self):
+        self.constraint_tuples = {}
+        self.constraint_reads = {}
+        self.check_scopes = {id(c): scope for c, scope in self.constraint_scopes}
+        interned: Dict[Tuple[Constraint, ...], Tuple[Constraint, ...]] = {}
+
+        for v in self.variables:
+            constraints = {id(c): c for c in self.constraints.get(v, ())}.values()
+
+            for c in constraints:
+                if hasattr(c, "fixed_value"):
+                    self.current_domains[v] &= sum(
+                        1 << i
+                        for i, d in enumerate(self.domains[v])
+                        if d == c.fixed_value
+                    )
+
+            constraints = [c for c in constraints if not hasattr(c, "fixed_value")]
+            peers = dict.fromkeys(
+                u
+                for c in constraints
+                if hasattr(c, "all_different")
+                for u in self.check_scopes[id(c)]
+                if u != v
+            )
+
+            if len(peers) > 0:
+                check = compile_peers_check(v, list(peers))
+                self.check_scopes[id(check)] = (v, *peers)
+                constraints = [
+                    c for c in constraints if not hasattr(c, "all_different")
+                ] + [check]
+
+            constraints = tuple(constraints)
+            self.constraint_tuples[v] = interned.setdefault(constraints, constraints)
+
+            reads = (v, *self.neighbors[v])
+            if len(self.constraint_tuples[v]) >= 2 and len(reads) <= MAX_CACHED_READS:
+                self.constraint_reads[v] = reads
+
+        self.valid_cache.clear()
+
+        check_neighbors = defaultdict(set)
+        all_different_groups = defaultdict(list)
+        grouped = set()
+        self.domain_bits = {}
+
+        for constraint, scope in self.constraint_scopes:
+            domain = self.domains[scope[0]] if len(scope) > 0 else None
+
+            if hasattr(constraint, "all_different") and all(
+                self.domains[u] is domain for u in scope
+            ):
+                bits = {d: 1 << i for i, d in enumerate(domain)}
+                grouped.add(id(constraint))
+                for u in scope:
+                    all_different_groups[u].append(scope)
+                    self.domain_bits[u] = bits
+            else:
+                for u in scope:
+                    check_neighbors[u].update(scope)
+
+        self.check_neighbors = {
+            v: tuple(neighbors - {v}) for v, neighbors in check_neighbors.items()
+        }
+        self.all_different_groups = {
+            v: tuple(groups) for v, groups in all_different_groups.items()
+        }
+
+        self.arcs = {
+            v: tuple((n, v) for n in self.get_neighbors(v)) for v in self.variables
+        }
+
+        degrees = {v: len(self.get_neighbors(v)) for v in self.variables}
+        self.degrees = degrees if len(set(degrees.values())) > 1 else None
+
+        self.assign_hooks = {}
+
+        for v in self.variables:
+            hooks = tuple(
+                c for c in self.constraint_tuples[v] if hasattr(c, "on_assign")
+            )
+            if len(hooks) > 0:
+                self.assign_hooks[v] = hooks
+
+        self.reset_constraints()
+
+        self.supports = {}
+        self.check_supports = {}
+
+        for (Xi, Xj), constraints in self.binary_constraints.items():
+            shared = {id(c) for c in self.constraints[Xi]} & {
+                id(c) for c in self.constraints[Xj]
+            }
+            binary = {id(c) for c in constraints}
+            if not shared <= binary | grouped:
+                continue
+
+            table = [
+                sum(
+                    1 << y
+                    for y, dy in enumerate(self.domains[Xj])
+                    if all(c({Xi: dx, Xj: dy}) for c in constraints)
+                )
+                for dx in self.domains[Xi]
+            ]
+
+            self.check_supports[Xi, Xj] = table
+            if shared == binary:
+                self.supports[Xi, Xj] = table
+
     def get_neighbors(self, variable: V) -> Dict[V, Set[D]]:
         return self.neighbors.get(variable, {})
 
-    def test_solution(self, solution: Solution, test_vals: Solution):
-        solution = solution.copy()
-        solution.update(test_vals)
-        return solution
-
     def is_valid(self, variable: V, solution: Solution):
-        return all((constraint(solution) for constraint in self.constraints[variable]))
+        constraints = self.constraint_tuples.get(variable, ())
+        reads = self.constraint_reads.get(variable)
+
+        if reads is None:
+            for constraint in constraints:
+                if not constraint(solution):
+                    return False
+            return True
+
+        key = (variable, *[solution.get(u, UNASSIGNED) for u in reads])
+        valid = self.valid_cache.get(key)
+
+        if valid is None:
+            if len(self.valid_cache) >= MAX_CACHE_SIZE:
+                self.valid_cache.clear()
+
+            valid = True
+            for constraint in constraints:
+                if not constraint(solution):
+                    valid = False
+                    break
+
+            self.valid_cache[key] = valid
+
+        return valid
+
+    def reset_constraints(self):
+        for constraint, _ in self.constraint_scopes:
+            if hasattr(constraint, "reset"):
+                constraint.reset()
+
+    def assign(self, variable: V, solution: Solution):
+        for constraint in self.assign_hooks.get(variable, ()):
+            constraint.on_assign(variable, solution[variable])
+
+    def unassign(self, variable: V, solution: Solution):
+        self.restore_pruned_domains(variable)
+
+        for constraint in self.assign_hooks.get(variable, ()):
+            constraint.on_unassign(variable, solution[variable])
+
+        del solution[variable]
 
     def restore_pruned_domains(self, variable: V):
-        for neighbor, d_list in self.pruned_map.get(variable, {}).items():
-            self.current_domains[neighbor].extend(d_list)
-            d_list.clear()
+        pruned = self.pruned_map.get(variable)
+        if pruned:
+            current_domains = self.current_domains
+            for neighbor, mask in pruned:
+                current_domains[neighbor] |= mask
+            pruned.clear()
 
     def revise(self, variable: V, Xi: V, Xj: V, solution: Solution):
-        removed = False
+        removed = self.inconsistent_values(Xi, Xj, solution)
 
-        for x in self.current_domains[Xi]:
-            for y in self.current_domains[Xj]:
-                if self.is_valid(Xj, self.test_solution(solution, {Xi: x, Xj: y})):
+        if removed:
+            self.current_domains[Xi] &= ~removed
+            self.pruned_map[variable].append((Xi, removed))
+
+        return removed != 0
+
+    def inconsistent_values(self, Xi: V, Xj: V, solution: Solution) -> DomainMask:
+        supports = self.supports.get((Xi, Xj))
+
+        if supports is None:
+            return self.unsupported_values(Xi, Xj, solution)
+
+        if Xj in solution:
+            mask_j = 1 << self.domains[Xj].index(solution[Xj])
+        else:
+            mask_j = self.current_domains[Xj]
+
+        removed = 0
+        for x in iter_bits(self.current_domains[Xi]):
+            if not supports[x] & mask_j:
+                removed |= 1 << x
+
+        return removed
+
+    def unsupported_values(self, Xi: V, Xj: V, solution: Solution) -> DomainMask:
+        is_valid = self.is_valid
+        domain_i = self.domains[Xi]
+        domain_j = self.domains[Xj]
+
+        assigned_j = Xj in solution
+        value_j = solution.get(Xj)
+
+        if assigned_j:
+            values_j = [value_j]
+        else:
+            values_j = [domain_j[y] for y in iter_bits(self.current_domains[Xj])]
+
+        removed = 0
+
+        for x in iter_bits(self.current_domains[Xi]):
+            solution[Xi] = domain_i[x]
+            for y in values_j:
+                solution[Xj] = y
+                if is_valid(Xj, solution):
                     break
             else:
-                self.current_domains[Xi].remove(x)
-                self.pruned_map[variable][Xi].add(x)
-                removed = True
+                removed |= 1 << x
+
+        solution.pop(Xi, None)
+        if assigned_j:
+            solution[Xj] = value_j
+        else:
+            solution.pop(Xj, None)
 
         return removed
 
     def forward_check(self, variable: V, solution: Solution):
-        agenda = [i for i in self.get_neighbors(variable) if i not in solution]
+        is_valid = self.is_valid
+        current_domains = self.current_domains
+        pruned = self.pruned_map[variable]
+
+        groups = self.all_different_groups.get(variable)
+
+        if groups:
+            bit = self.domain_bits[variable][solution[variable]]
+
+            for scope in groups:
+                free = 0
+                union = 0
+
+                for u in scope:
+                    if u in solution:
+                        continue
+                    if current_domains[u] & bit:
+                        current_domains[u] ^= bit
+                        pruned.append((u, bit))
+
+                        if current_domains[u] == 0:
+                            return False
+
+                    free += 1
+                    union |= current_domains[u]
+
+                if union.bit_count() < free:
+                    return False
+
+        agenda = [
+            i for i in self.check_neighbors.get(variable, ()) if i not in solution
+        ]
+        check_supports = self.check_supports
+        index = None
 
         for Xi in agenda:
-            for x in list(self.current_domains[Xi]):
-                if not self.is_valid(Xi, self.test_solution(solution, {Xi: x})):
-                    self.current_domains[Xi].remove(x)
-                    self.pruned_map[variable][Xi].add(x)
+            supports = check_supports.get((variable, Xi))
+
+            if supports is not None:
+                if index is None:
+                    index = self.domains[variable].index(solution[variable])
+                removed = current_domains[Xi] & ~supports[index]
+            else:
+                domain = self.domains[Xi]
+                removed = 0
+
+                for x in iter_bits(current_domains[Xi]):
+                    solution[Xi] = domain[x]
+                    if not is_valid(Xi, solution):
+                        removed |= 1 << x
+
+                solution.pop(Xi, None)
+
+            if removed:
+                current_domains[Xi] &= ~removed
+                pruned.append((Xi, removed))
+
+                if current_domains[Xi] == 0:
+                    return False
+
+        return True
 
     def AC_FC(self, variable: V, solution: Solution):
-        consistent = True
-        agenda = deque(
-            (
-                (Xj, variable)
-                for Xj in self.get_neighbors(variable)
-                if Xj not in solution
-            )
-        )
+        agenda = deque(arc for arc in self.arcs[variable] if arc[0] not in solution)
         while len(agenda) > 0 and self.is_valid(variable, solution):
             Xi, Xj = agenda.pop()
             if self.revise(variable, Xi, Xj, solution):
-                consistent = len(self.current_domains[Xi]) > 0
-        return consistent
+                if self.current_domains[Xi] == 0:
+                    return False
+        return True
 
     def AC3(self, variable: V, solution: Solution):
-        agenda = deque(
-            (
-                (Xj, variable)
-                for Xj in self.get_neighbors(variable)
-                if Xj not in solution
-            )
-        )
+        arcs = self.arcs
+        agenda = deque(arc for arc in arcs[variable] if arc[0] not in solution)
+        queued = set(agenda)
+
         while len(agenda) > 0:
-            Xi, Xj = agenda.pop()
+            arc = agenda.popleft()
+            queued.discard(arc)
+
+            Xi, Xj = arc
             if self.revise(variable, Xi, Xj, solution):
-                for Xk in self.get_neighbors(Xi):
-                    p = (Xk, Xi)
-                    if Xk != Xj and p not in agenda and Xk not in solution:
+                if self.current_domains[Xi] == 0:
+                    return False
+                for p in arcs[Xi]:
+                    Xk = p[0]
+                    if Xk != Xj and p not in queued and Xk not in solution:
+                        queued.add(p)
                         agenda.append(p)
+        return True
+
+    def initial_AC3(self):
+        arcs = self.arcs
+        agenda = deque(arc for v in self.variables for arc in arcs[v])
+        queued = set(agenda)
+
+        while len(agenda) > 0:
+            arc = agenda.popleft()
+            queued.discard(arc)
+
+            Xi, Xj = arc
+            removed = self.inconsistent_values(Xi, Xj, {})
+
+            if removed:
+                self.current_domains[Xi] &= ~removed
+                if self.current_domains[Xi] == 0:
+                    return False
+                for p in arcs[Xi]:
+                    if p[0] != Xj and p not in queued:
+                        queued.add(p)
+                        agenda.append(p)
+        return True
 
     def get_next_variable(self) -> V:
         if self.variable_ordering == VariableOrdering.FAIL_FIRST:
-            current_domains = {
-                v: ds
-                for v, ds in self.current_domains.items()
-                if v in self.variable_stack
-            }
-            v, _ = min(current_domains.items(), key=lambda x: len(x[1]))
-            self.variable_stack.remove(v)
+            variable_stack = self.variable_stack
+            masks = map(self.current_domains.__getitem__, variable_stack)
+            sizes = list(map(int.bit_count, masks))
+            smallest = min(sizes)
+            i = sizes.index(smallest)
+
+            degrees = self.degrees
+            if degrees is not None and sizes.count(smallest) > 1:
+                i = max(
+                    (j for j in range(i, len(sizes)) if sizes[j] == smallest),
+                    key=lambda j: degrees[variable_stack[j]],
+                )
+
+            v = variable_stack[i]
+            del variable_stack[i]
             return v
         elif self.variable_ordering == VariableOrdering.NO_ORDERING:
             return self.variable_stack.pop()
 
-    def backtrack(self, solution: Solution):
-        if len(solution) == len(self.variables):
-            self.solutions.append(solution.copy())
-            return len(self.solutions) >= self.max_solutions
+    def least_constraining_values(self, v: V, solution: Solution) -> List[int]:
+        is_valid = self.is_valid
+        current_domains = self.current_domains
+        domain = self.domains[v]
+        neighbors = [n for n in self.get_neighbors(v) if n not in solution]
+
+        def ruled_out(i: int):
+            solution[v] = domain[i]
+            count = 0
+
+            for n in neighbors:
+                domain_n = self.domains[n]
+                for y in iter_bits(current_domains[n]):
+                    solution[n] = domain_n[y]
+                    if not is_valid(n, solution):
+                        count += 1
+                solution.pop(n, None)
+
+            return count
 
+        values = sorted(iter_bits(current_domains[v]), key=ruled_out)
+        solution.pop(v, None)
+
+        return values
+
+    def next_frame(self, solution: Solution):
         v = self.get_next_variable()
-        for d in self.current_domains[v]:
-            solution[v] = d
 
-            if self.is_valid(v, solution):
-                self.pruning_function(v, solution)
+        if self.value_ordering == ValueOrdering.LEAST_CONSTRAINING:
+            candidates = iter(self.least_constraining_values(v, solution))
+        else:
+            candidates = iter_bits(self.current_domains[v])
 
-                if self.backtrack(solution):
-                    return True
+        return (v, self.domains[v], self.constraint_tuples[v], candidates)
 
-            self.restore_pruned_domains(v)
-            del solution[v]
+    def backtrack(self, solution: Solution):
+        for found in self.iter_backtrack(solution):
+            self.solutions.append(found)
+            if len(self.solutions) >= self.max_solutions:
+                return True
+
+        return False
+
+    def iter_backtrack(self, solution: Solution) -> Iterator[Solution]:
+        n_variables = len(self.variables)
+
+        if len(solution) == n_variables:
+            yield solution.copy()
+            return
+
+        stack = [self.next_frame(solution)]
+
+        while stack:
+            v, domain, constraints, candidates = stack[-1]
+
+            if v in solution:
+                self.unassign(v, solution)
+
+            for i in candidates:
+                solution[v] = domain[i]
+
+                for constraint in constraints:
+                    if not constraint(solution):
+                        break
+                else:
+                    break
+            else:
+                solution.pop(v, None)
+                self.variable_stack.append(v)
+                stack.pop()
+                continue
+
+            self.assign(v, solution)
+
+            if not self.pruning_function(v, solution):
+                continue
+
+            if len(solution) == n_variables:
+                yield solution.copy()
+            else:
+                stack.append(self.next_frame(solution))
+
+    def pruning_culprits(self, variable: V, solution: Solution) -> Set[V]:
+        if self.pruning_type == PruningType.FORWARD_CHECKING:
+            for Xi in self.get_neighbors(variable):
+                if Xi not in solution and self.current_domains[Xi] == 0:
+                    return solution.keys() & self.get_neighbors(Xi)
+
+        return set(solution)
+
+    def backjump(self, solution: Solution):
+        for found in self.iter_backjump(solution):
+            self.solutions.append(found)
+            if len(self.solutions) >= self.max_solutions:
+                return True
 
-        self.variable_stack.append(v)
         return False
 
+    def iter_backjump(self, solution: Solution) -> Iterator[Solution]:
+        n_variables = len(self.variables)
+
+        if len(solution) == n_variables:
+            yield solution.copy()
+            return
+
+        scopes = self.check_scopes
+        pruning = self.pruning_type != PruningType.NO_PRUNING
+
+        stack = [(*self.next_frame(solution), set())]
+
+        while stack:
+            v, domain, constraints, candidates, conflicts = stack[-1]
+
+            if v in solution:
+                self.unassign(v, solution)
+
+            for i in candidates:
+                solution[v] = domain[i]
+
+                for constraint in constraints:
+                    if not constraint(solution):
+                        if not pruning:
+                            conflicts.update(
+                                u for u in scopes[id(constraint)] if u in solution
+                            )
+                        break
+                else:
+                    break
+            else:
+                solution.pop(v, None)
+
+                if pruning:
+                    conflicts |= solution.keys() & self.get_neighbors(v)
+                conflicts.discard(v)
+
+                self.variable_stack.append(v)
+                stack.pop()
+
+                while stack and stack[-1][0] not in conflicts:
+                    u = stack.pop()[0]
+                    self.unassign(u, solution)
+                    self.variable_stack.append(u)
+
+                if stack:
+                    stack[-1][-1].update(conflicts)
+                continue
+
+            self.assign(v, solution)
+
+            if not self.pruning_function(v, solution):
+                conflicts.update(self.pruning_culprits(v, solution))
+                continue
+
+            if len(solution) == n_variables:
+                yield solution.copy()
+                conflicts.update(solution)
+            else:
+                stack.append((*self.next_frame(solution), set()))
+
     def num_conflicts(self, v: V, d: D, solution: Solution):
-        count = 0
+        return int(self.domain_conflicts(v, [d], solution)[0])
+
+    def domain_conflicts(self, v: V, domain: List[D], solution: Solution):
+        conflicts = np.zeros(len(domain), dtype=np.intp)
+        generic = []
+
+        for constraint in self.constraints.get(v, ()):
+            count = getattr(constraint, "conflicts", None)
+
+            if count is not None:
+                conflicts += count(v, domain, solution)
+            else:
+                generic.append(constraint)
+
+        if len(generic) == 0:
+            return conflicts
+
+        assigned = v in solution
+        value = solution.get(v)
+
+        for i, d in enumerate(domain):
+            solution[v] = d
 
-        t_solution = self.test_solution(solution, {v: d})
+            for constraint in generic:
+                if not constraint(solution):
+                    conflicts[i] += 1
 
-        for constraint in self.constraints[v]:
-            consistent = constraint(t_solution)
-            if not consistent:
-                count += 1
+        if assigned:
+            solution[v] = value
+        else:
+            del solution[v]
 
-        return count
+        return conflicts
 
     def conflicting_variables(self, solution: Solution):
         return [
@@ -201,10 +718,19 @@ class CSP:
             if v in solution and self.num_conflicts(v, solution[v], solution) > 0
         ]
 
+    def candidate_values(self, v: V) -> List[D]:
+        domain = self.domains[v]
+        mask = self.root_masks.get(v)
+
+        if mask is None:
+            return domain
+
+        return [domain[i] for i in iter_bits(mask & ((1 << len(domain)) - 1))]
+
     def min_conflicting_value(self, v: V, solution: Solution) -> D:
-        domains = self.domains[v]
-        conflicts = [self.num_conflicts(v, d, solution) for d in domains]
-        ix = np.argmin(conflicts)
+        domains = self.candidate_values(v)
+        conflicts = self.domain_conflicts(v, domains, solution)
+        ix = random.choice(np.flatnonzero(conflicts == conflicts.min()))
 
         return domains[ix]
 
@@ -212,6 +738,9 @@ class CSP:
         solution = {}
         random.shuffle(self.variables)
 
+        if any(len(self.candidate_values(v)) == 0 for v in self.root_masks):
+            return False
+
         for v in self.variables:
             solution[v] = self.min_conflicting_value(v, solution)
 
@@ -228,103 +757,500 @@ class CSP:
 
         return False
 
-    def solve(self):
+    def initialize(self):
         self.variable_stack.clear()
         self.current_domains.clear()
+        self.pruned_map.clear()
 
         for v in self.variables:
             self.variable_stack.append(v)
-            self.current_domains[v] = list(self.domains[v])
-            self.pruned_map[v].clear()
+            self.current_domains[v] = (1 << len(self.domains[v])) - 1
+            self.pruned_map[v] = []
+
+        self.finalize()
+
+        for v, mask in self.root_masks.items():
+            self.current_domains[v] &= mask
 
         self.solutions = []
 
+        if self.pruning_type in (PruningType.AC3, PruningType.AC_FC):
+            return self.initial_AC3()
+        else:
+            return True
+
+    def solve(self):
+        if not self.initialize():
+            return False
+
         solution = {}
 
-        return self.backtrack(solution=solution)
+        try:
+            if self.backjumping:
+                return self.backjump(solution=solution)
+            else:
+                return self.backtrack(solution=solution)
+        finally:
+            self.reset_constraints()
+
+    def iter_solutions(self) -> Iterator[Solution]:
+        if not self.initialize():
+            return
 
+        search = self.iter_backjump if self.backjumping else self.iter_backtrack
 
-def get_current_solution_values(
-    variables: List[V], current_solution: Solution
-) -> Optional[List[D]]:
-    current_values = []
-    for v in variables:
-        if v in current_solution:
-            current_values.append(current_solution[v])
+        try:
+            yield from search({})
+        finally:
+            self.reset_constraints()
 
-    return current_values
+    def solve_parallel(self, n_workers: Optional[int] = None):
+        global _parallel_csp
+
+        if "fork" not in multiprocessing.get_all_start_methods():
+            return self.solve()
+
+        if not self.initialize() or len(self.variables) == 0:
+            return False
+
+        v = self.get_next_variable()
+        branches = list(iter_bits(self.current_domains[v]))
+
+        _parallel_csp = self
+
+        try:
+            solutions = run_branches(
+                multiprocessing.get_context("fork"),
+                _solve_branch,
+                [(v, i) for i in branches],
+                self.max_solutions,
+                n_workers,
+            )
+        finally:
+            _parallel_csp = None
+
+        self.solutions = solutions[: self.max_solutions]
+
+        return len(self.solutions) >= self.max_solutions
+
+    def solve_portfolio(self, timeout: Optional[float] = None):
+        global _parallel_csp
+
+        if "fork" not in multiprocessing.get_all_start_methods():
+            return self.solve()
+
+        strategies = [PruningType.FORWARD_CHECKING, PruningType.AC3, PruningType.AC_FC]
+        if self.max_solutions == 1:
+            strategies.append(None)
+
+        context = multiprocessing.get_context("fork")
+        results = context.Queue()
+
+        _parallel_csp = self
+        workers = []
+
+        try:
+            for strategy in strategies:
+                worker = context.Process(
+                    target=_run_strategy, args=(strategy, results), daemon=True
+                )
+                worker.start()
+                workers.append(worker)
+        finally:
+            _parallel_csp = None
+
+        deadline = None if timeout is None else time.monotonic() + timeout
+        self.solutions = []
+        found = False
+
+        try:
+            for _ in workers:
+                complete, found, solutions = wait_for_result(results, workers, deadline)
+
+                if found or complete:
+                    self.solutions = solutions
+                    break
+        except queue.Empty:
+            found = False
+        finally:
+            for worker in workers:
+                worker.terminate()
+            for worker in workers:
+                worker.join()
+
+        return found
+
+
+_parallel_csp: Optional[CSP] = None
+
+
+def wait_for_result(
+    results: multiprocessing.Queue,
+    workers: List[multiprocessing.Process],
+    deadline: Optional[float],
+) -> Any:
+    while True:
+        exited = all(worker.exitcode is not None for worker in workers)
+
+        wait = POLL_INTERVAL
+        if deadline is not None:
+            wait = min(wait, max(0.0, deadline - time.monotonic()))
+
+        try:
+            result = results.get(timeout=wait)
+        except queue.Empty:
+            if exited:
+                raise RuntimeError("Every worker exited without a result")
+            if deadline is not None and time.monotonic() >= deadline:
+                raise
+            continue
+
+        if isinstance(result, BaseException):
+            raise result
+
+        return result
+
+
+def run_branches(
+    context: multiprocessing.context.BaseContext,
+    target: Callable[..., List[Solution]],
+    branches: List[Tuple],
+    max_solutions: int,
+    n_workers: Optional[int] = None,
+) -> List[Solution]:
+    n_workers = n_workers or os.cpu_count() or 1
+    results = context.Queue()
+
+    pending = deque(branches)
+    workers = []
+    outstanding = 0
+    solutions = []
+
+    try:
+        while pending or outstanding > 0:
+            while pending and outstanding < n_workers:
+                worker = context.Process(
+                    target=_run_branch,
+                    args=(results, target, pending.popleft()),
+                    daemon=True,
+                )
+                worker.start()
+                workers.append(worker)
+                outstanding += 1
+
+            solutions.extend(wait_for_result(results, workers, None))
+            outstanding -= 1
+
+            if len(solutions) >= max_solutions:
+                break
+    finally:
+        for worker in workers:
+            worker.terminate()
+        for worker in workers:
+            worker.join()
+
+    return solutions
+
+
+def _run_branch(
+    results: multiprocessing.Queue,
+    target: Callable[..., List[Solution]],
+    args: Tuple,
+) -> None:
+    try:
+        solutions = target(*args)
+    except Exception as e:
+        results.put(e)
+        return
+
+    results.put(solutions)
+
+
+def _solve_branch(variable: V, index: int) -> List[Solution]:
+    csp = _parallel_csp
+    csp.root_masks = {**csp.root_masks, variable: 1 << index}
+    csp.solve()
+
+    return csp.solutions
+
+
+def _run_strategy(
+    pruning_type: Optional[PruningType], results: multiprocessing.Queue
+) -> None:
+    csp = _parallel_csp
+
+    try:
+        if pruning_type is None:
+            found = csp.min_conflicts()
+        else:
+            csp.set_pruning_type(pruning_type)
+            found = csp.solve()
+    except Exception as e:
+        results.put(e)
+        return
+
+    results.put((pruning_type is not None, found, csp.solutions))
 
 
 def map_coloring_constraint(p1: str, p2: str):
     def check(current_solution: Solution):
-        if p1 not in current_solution or p2 not in current_solution:
-            return True
-        else:
-            return current_solution[p1] != current_solution[p2]
+        c1 = current_solution.get(p1, UNASSIGNED)
+        return c1 is UNASSIGNED or current_solution.get(p2, UNASSIGNED) != c1
+
+    check.key = ("map_coloring", frozenset((p1, p2)))
 
     return check, [p1, p2]
 
 
 def n_queens_constraint(columns: List[int]):
+    n = len(columns)
+    placed: Dict[int, int] = {}
+    masks = [0, 0, 0]
+
+    def queen_bits(column: int, row: int):
+        return 1 << row, 1 << (row - column + n), 1 << (row + column)
+
     def check(current_solution: Solution):
-        for (
-            q1c,
-            q1r,
-        ) in current_solution.items():
-            for q2c in range(q1c + 1, len(columns) + 1):
-                if q2c in current_solution:
-                    q2r = current_solution[q2c]
-                    if q1r == q2r:
-                        return False
-                    if abs(q1r - q2r) == abs(q1c - q2c):
-                        return False
+        if len(current_solution) == len(placed) + 1:
+            column = next(reversed(current_solution))
+
+            if column not in placed:
+                r, d, a = queen_bits(column, current_solution[column])
+                return not (masks[0] & r or masks[1] & d or masks[2] & a)
+
+        rows = diagonals = anti_diagonals = 0
+
+        for column, row in current_solution.items():
+            r, d, a = queen_bits(column, row)
+
+            if rows & r or diagonals & d or anti_diagonals & a:
+                return False
+
+            rows |= r
+            diagonals |= d
+            anti_diagonals |= a
+
         return True
 
+    def on_assign(column: int, row: int):
+        placed[column] = row
+        for i, bit in enumerate(queen_bits(column, row)):
+            masks[i] |= bit
+
+    def on_unassign(column: int, row: int):
+        del placed[column]
+        for i, bit in enumerate(queen_bits(column, row)):
+            masks[i] ^= bit
+
+    def reset():
+        placed.clear()
+        masks[:] = [0, 0, 0]
+
+    def conflicts(column: int, rows: List[int], current_solution: Solution):
+        others = [(c, r) for c, r in current_solution.items() if c != column]
+
+        if len(others) == 0:
+            return np.zeros(len(rows), dtype=np.intp)
+
+        placed_columns, placed_rows = np.array(others).T
+        rows = np.asarray(rows)[:, np.newaxis]
+
+        attacks = (placed_rows == rows) | (
+            np.abs(placed_rows - rows) == np.abs(placed_columns - column)
+        )
+
+        return attacks.sum(axis=1)
+
+    check.on_assign = on_assign
+    check.on_unassign = on_unassign
+    check.reset = reset
+    check.conflicts = conflicts
+    check.key = ("n_queens", tuple(columns))
+
     return check, list(columns)
 
 
 def lambda_constraint(func: Callable[[Any], bool], *variables):
+    if len(variables) == 1:
+        (a,) = variables
+
+        def check(current_solution: Solution):
+            return a not in current_solution or func(current_solution[a])
+
+        return check, list(variables)
+
+    if len(variables) == 2:
+        a, b = variables
+
+        def check(current_solution: Solution):
+            return (
+                a not in current_solution
+                or b not in current_solution
+                or func(current_solution[a], current_solution[b])
+            )
+
+        return check, list(variables)
+
     def check(current_solution: Solution):
-        current_values = get_current_solution_values(variables, current_solution)
+        for v in variables:
+            if v not in current_solution:
+                return True
 
-        if len(variables) == len(current_values):
-            return func(*current_values)
-        else:
-            return True
+        return func(*[current_solution[v] for v in variables])
 
     return check, list(variables)
 
 
 def less_than_constraint(a, b):
-    return lambda_constraint(lambda x, y: x < y, a, b)
+    check, variables = lambda_constraint(lambda x, y: x < y, a, b)
+    check.key = ("less_than", a, b)
+
+    return check, variables
 
 
 def greater_than_constraint(a, b):
-    return lambda_constraint(lambda x, y: x > y, a, b)
+    check, variables = lambda_constraint(lambda x, y: x > y, a, b)
+    check.key = ("less_than", b, a)
+
+    return check, variables
 
 
 def equals_constraint(node, value: int):
-    return lambda_constraint(lambda x: x == value, node)
+    check, variables = lambda_constraint(lambda x: x == value, node)
+    check.fixed_value = value
+    check.key = ("equals", node, value)
+
+    return check, variables
+
+
+def compile_all_different_check(variables: List[V]) -> Constraint:
+    names = [f"v{i}" for i in range(len(variables))]
+
+    lines = [
+        f"def check(current_solution, {', '.join(f'{n}={n}' for n in names)}):",
+        "    bits = 0",
+        "    try:",
+        "        pass",
+    ]
+    for n in names:
+        lines += [
+            f"        if {n} in current_solution:",
+            f"            value = current_solution[{n}]",
+            "            if not 0 <= value < 64:",
+            "                raise ValueError",
+            "            bit = 1 << value",
+            "            if bits & bit:",
+            "                return False",
+            "            bits |= bit",
+        ]
+    lines += [
+        "    except (TypeError, ValueError):",
+        "        seen = set()",
+        "        for v in variables:",
+        "            if v in current_solution:",
+        "                value = current_solution[v]",
+        "                if value in seen:",
+        "                    return False",
+        "                seen.add(value)",
+        "    return True",
+    ]
+
+    namespace = dict(zip(names, variables))
+    namespace["variables"] = variables
+
+    exec(compile("\n".join(lines), "<all_different_constraint>", "exec"), namespace)
+
+    return namespace["check"]
+
+
+def compile_peers_check(variable: V, peers: List[V]) -> Constraint:
+    names = [f"p{i}" for i in range(len(peers))]
+
+    lines = [
+        f"def check(current_solution, v=v, {', '.join(f'{n}={n}' for n in names)}):",
+        "    if v not in current_solution:",
+        "        return True",
+        "    value = current_solution[v]",
+    ]
+    for n in names:
+        lines += [
+            f"    if {n} in current_solution and current_solution[{n}] == value:",
+            "        return False",
+        ]
+    lines += ["    return True"]
+
+    namespace = dict(zip(names, peers))
+    namespace["v"] = variable
+
+    exec(compile("\n".join(lines), "<all_different_peers>", "exec"), namespace)
+
+    return namespace["check"]
 
 
 def all_different_constraint(*variables):
-    def check(current_solution: Solution):
-        current_values = get_current_solution_values(variables, current_solution)
-        return len(current_values) == len(set(current_values))
+    if len(variables) == 1 and isinstance(variables[0], np.ndarray):
+        variables = variables[0].ravel().tolist()
+    elif len(variables) == 1 and isinstance(variables[0], list):
+        variables = variables[0]
+
+    check = compile_all_different_check(list(variables))
+    check.all_different = True
+    check.key = ("all_different", frozenset(variables))
 
     return check, list(variables)
 
 
+class NQueensCSP(CSP):
+    def __init__(self, n: int, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+
+        self.n = n
+
+    def uses_symmetry(self) -> bool:
+        columns = tuple(range(1, self.n + 1))
+
+        return (
+            len(self.root_masks) == 0
+            and len(self.constraint_scopes) == 1
+            and getattr(self.constraint_scopes[0][0], "key", None)
+            == ("n_queens", columns)
+        )
+
+    def iter_solutions(self) -> Iterator[Solution]:
+        if not self.uses_symmetry():
+            yield from super().iter_solutions()
+            return
+
+        n = self.n
+        self.root_masks = {1: (1 << (n + 1) // 2) - 1}
+
+        try:
+            for solution in super().iter_solutions():
+                yield solution
+                if solution[1] <= n // 2:
+                    yield {c: n + 1 - r for c, r in solution.items()}
+        finally:
+            self.root_masks = {}
+
+    def solve(self):
+        solutions = self.iter_solutions()
+        self.solutions = list(itertools.islice(solutions, self.max_solutions))
+        solutions.close()
+
+        return len(self.solutions) >= self.max_solutions
+
+
 def n_queens(
     n: int,
     pruning_type: PruningType,
     variable_ordering: VariableOrdering,
     max_solutions: int = 1000,
+    value_ordering: ValueOrdering = ValueOrdering.NO_ORDERING,
 ):
     domain = list(range(1, n + 1))
     variables = list(domain)
 
-    csp = CSP(pruning_type, variable_ordering, max_solutions)
+    csp = NQueensCSP(n, pruning_type, variable_ordering, max_solutions, value_ordering)
     csp.add_variables(domain, *variables)
     csp.add_constraint(n_queens_constraint(variables))
 
@@ -335,6 +1261,7 @@ def map_coloring(
     pruning_type: PruningType,
     variable_ordering: VariableOrdering,
     max_solutions: int = 1000,
+    value_ordering: ValueOrdering = ValueOrdering.NO_ORDERING,
 ):
     variables = [
         "Western Australia",
@@ -347,7 +1274,7 @@ def map_coloring(
     ]
     domain = ["red", "green", "blue"]
 
-    csp = CSP(pruning_type, variable_ordering, max_solutions)
+    csp = CSP(pruning_type, variable_ordering, max_solutions, value_ordering)
 
     csp.add_variables(domain, *variables)
 
@@ -368,7 +1295,7 @@ def map_coloring(
 
 
 def test_solutions(csp: CSP):
-    solutions = list(map(str, csp.solutions))
+    solutions = [frozenset(solution.items()) for solution in csp.solutions]
     unique_solutions = set(solutions)
 
     pprint.pprint(csp.solutions)
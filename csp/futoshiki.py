@@ -1,6 +1,5 @@
 import math
 import sys
-from dataclasses import dataclass
 from typing import *
 
 import numpy as np
@@ -9,19 +8,10 @@ from csp.csp import (
     CSP,
     PruningType,
     all_different_constraint,
-    equals_constraint,
     greater_than_constraint,
 )
 
 
-@dataclass(frozen=True)
-class Node:
-    pos: Tuple[int, int]
-
-    def __repr__(self):
-        return str(self.pos)
-
-
 def create_futoshiki_csp(filename: str, pruning_type: PruningType) -> CSP:
     def split_line(line: str):
         return list(map(int, line.split(" ")))
@@ -34,26 +24,26 @@ def create_futoshiki_csp(filename: str, pruning_type: PruningType) -> CSP:
         As = split_line(file.readline())
         Bs = split_line(file.readline())
 
-        grid: np.array = np.asarray([Node((i, j)) for i in range(N) for j in range(N)])
+        grid = np.arange(N * N)
 
         csp = CSP(pruning_type=pruning_type, max_solutions=99999)
 
         domain = list(range(1, N + 1))
-        csp.add_variables(domain, *grid)
+        csp.add_variables(domain, *grid.tolist())
 
         for ix, value in zip(Ls, Vs):
-            csp.add_constraint(equals_constraint(grid[ix], value))
+            csp.set_value(ix, value)
 
         for a, b in zip(As, Bs):
-            csp.add_constraint(greater_than_constraint(grid[a], grid[b]))
+            csp.add_constraint(greater_than_constraint(a, b))
 
         grid = grid.reshape((N, N))
 
         for row in grid:
-            csp.add_constraint(all_different_constraint(*row))
+            csp.add_constraint(all_different_constraint(row))
 
         for column in grid.T:
-            csp.add_constraint(all_different_constraint(*column))
+            csp.add_constraint(all_different_constraint(column))
 
         return csp
 
@@ -63,8 +53,7 @@ def print_solutions(csp: CSP):
 
     for solution in csp.solutions:
         for i in range(N):
-            nodes = (csp.variables[i * N + j] for j in range(N))
-            row = ", ".join(map(lambda x: str(solution.get(x)), nodes))
+            row = ", ".join(str(solution[i * N + j]) for j in range(N))
             print(row)
         print("###############")
 
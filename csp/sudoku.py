@@ -1,9 +1,16 @@
+import functools
+import itertools
 import json
 import math
+import multiprocessing
 import os
 import pathlib
+import queue
 import random
+import time
+from concurrent.futures import ProcessPoolExecutor
 from enum import Enum, auto
+from types import MappingProxyType
 from typing import *
 
 import numpy as np
@@ -11,9 +18,10 @@ import numpy as np
 from csp.csp import (
     CSP,
     PruningType,
+    ValueOrdering,
     VariableOrdering,
-    all_different_constraint,
-    equals_constraint,
+    run_branches,
+    wait_for_result,
 )
 
 DIR_PATH = pathlib.Path(os.path.dirname(__file__))
@@ -32,66 +40,423 @@ class SudokuDifficulty(Enum):
             return default
 
 
+@functools.lru_cache(maxsize=None)
+def sudoku_units(N: int) -> Tuple[Tuple[int, int, int], ...]:
+    M = N**2
+    return tuple(
+        (pos // M, pos % M, (pos // M) // N * N + (pos % M) // N) for pos in range(M**2)
+    )
+
+
+@functools.lru_cache(maxsize=None)
+def sudoku_domain(M: int) -> Tuple[int, ...]:
+    return tuple(range(1, M + 1))
+
+
+@functools.lru_cache(maxsize=None)
+def sudoku_groups(N: int) -> Tuple[Tuple[int, ...], ...]:
+    M = N**2
+    grid = np.arange(M**2).reshape((M, M))
+    subgrids = grid.reshape((N, N, N, N)).transpose(0, 2, 1, 3).reshape((M, M))
+
+    return tuple(map(tuple, np.concatenate((grid, grid.T, subgrids)).tolist()))
+
+
+@functools.lru_cache(maxsize=None)
+def compile_unit_scan(N: int) -> Callable[..., Optional[Tuple]]:
+    M = N**2
+    lines = [f"def scan(masks, rows, cols, boxes, full={(1 << M) - 1}):"]
+    used = [f"{name}[{i}]" for name in ("rows", "cols", "boxes") for i in range(M)]
+    lines += [f"    {', '.join(f'm{pos}' for pos in range(M**2))}, = masks"]
+
+    for u, cells in enumerate(sudoku_groups(N)):
+        lines += [f"    once = m{cells[0]}", "    twice = 0"]
+        for pos in cells[1:]:
+            lines += [f"    twice |= once & m{pos}", f"    once |= m{pos}"]
+
+        lines += [
+            f"    if once | {used[u]} != full:",
+            "        return -1, 0",
+            "    hidden = once & ~twice",
+            "    if hidden:",
+            "        bit = hidden & -hidden",
+        ]
+        for pos in cells:
+            lines += [
+                f"        if m{pos} & bit:",
+                f"            return {pos}, bit",
+            ]
+
+    lines += ["    return None"]
+
+    namespace = {}
+    exec(compile("\n".join(lines), f"<sudoku_unit_scan_{N}>", "exec"), namespace)
+
+    return namespace["scan"]
+
+
+def backtrack_sudoku(
+    N: int,
+    units: Sequence[Tuple[int, int, int]],
+    givens: Dict[int, int],
+    max_solutions: int = 1,
+    seed: Optional[int] = None,
+) -> List[Dict[int, int]]:
+    solutions = iter_sudoku_solutions(N, units, givens, seed)
+    return list(itertools.islice(solutions, max_solutions))
+
+
+def iter_sudoku_solutions(
+    N: int,
+    units: Sequence[Tuple[int, int, int]],
+    givens: Dict[int, int],
+    seed: Optional[int] = None,
+) -> Iterator[Dict[int, int]]:
+    M = N**2
+    full = (1 << M) - 1
+
+    rows = [0] * M
+    cols = [0] * M
+    boxes = [0] * M
+    board = [0] * (M**2)
+
+    for pos, value in givens.items():
+        if not 0 <= pos < M**2 or not 1 <= value <= M:
+            return
+
+        r, c, b = units[pos]
+        bit = 1 << (value - 1)
+
+        if (rows[r] | cols[c] | boxes[b]) & bit:
+            return
+
+        rows[r] |= bit
+        cols[c] |= bit
+        boxes[b] |= bit
+        board[pos] = value
+
+    scan = compile_unit_scan(N)
+
+    empty = [pos for pos in range(M**2) if board[pos] == 0]
+    n_empty = len(empty)
+
+    if seed is not None:
+        random.Random(seed).shuffle(empty)
+
+    masks = [0] * (M**2)
+    candidates = [-1] * n_empty
+    placed = [0] * n_empty
+
+    depth = 0
+    while depth >= 0:
+        if depth == n_empty:
+            yield dict(enumerate(board))
+            depth -= 1
+            continue
+
+        if candidates[depth] < 0:
+            best, best_mask, best_count = depth, 0, M + 1
+
+            for i in range(depth, n_empty):
+                pos = empty[i]
+                r, c, b = units[pos]
+                mask = full & ~(rows[r] | cols[c] | boxes[b])
+                masks[pos] = mask
+                count = mask.bit_count()
+
+                if count < best_count:
+                    best, best_mask, best_count = i, mask, count
+                    if count <= 1:
+                        break
+
+            if best_count > 1:
+                found = scan(masks, rows, cols, boxes)
+
+                if found is not None:
+                    pos, best_mask = found
+                    if best_mask:
+                        best = empty.index(pos, depth)
+
+            empty[depth], empty[best] = empty[best], empty[depth]
+            candidates[depth] = best_mask
+            masks[empty[depth]] = 0
+
+        pos = empty[depth]
+        r, c, b = units[pos]
+
+        bit = placed[depth]
+        if bit:
+            rows[r] ^= bit
+            cols[c] ^= bit
+            boxes[b] ^= bit
+            placed[depth] = 0
+
+        mask = candidates[depth]
+        if mask == 0:
+            board[pos] = 0
+            candidates[depth] = -1
+            depth -= 1
+            continue
+
+        bit = mask & -mask
+        candidates[depth] = mask ^ bit
+
+        rows[r] |= bit
+        cols[c] |= bit
+        boxes[b] |= bit
+        placed[depth] = bit
+        board[pos] = bit.bit_length()
+
+        depth += 1
+
+
+class SudokuCSP(CSP):
+    def __init__(self, N: int, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+
+        self.N = N
+        self.givens: Dict[int, int] = {}
+
+    def uses_kernel(self) -> bool:
+        M = self.N**2
+        domain = sudoku_domain(M)
+        groups = {frozenset(group) for group in sudoku_groups(self.N)}
+        scopes = [frozenset(scope) for _, scope in self.constraint_scopes]
+        givens = {
+            pos: mask.bit_length()
+            for pos, mask in self.root_masks.items()
+            if mask.bit_count() == 1
+        }
+
+        return (
+            len(self.variables) == M**2
+            and set(self.variables) == set(range(M**2))
+            and all(tuple(self.domains[v]) == domain for v in self.variables)
+            and len(scopes) == len(groups)
+            and set(scopes) == groups
+            and all(hasattr(c, "all_different") for c, _ in self.constraint_scopes)
+            and len(givens) == len(self.root_masks)
+            and givens == self.givens
+            and self.pruning_type == PruningType.FORWARD_CHECKING
+            and self.variable_ordering == VariableOrdering.FAIL_FIRST
+            and self.value_ordering == ValueOrdering.NO_ORDERING
+            and not self.backjumping
+        )
+
+    def solve(self):
+        if not self.uses_kernel():
+            return super().solve()
+
+        solutions = self.iter_solutions()
+        self.solutions = list(itertools.islice(solutions, self.max_solutions))
+        solutions.close()
+
+        return len(self.solutions) >= self.max_solutions
+
+    def iter_solutions(self) -> Iterator[Dict[int, int]]:
+        if not self.uses_kernel():
+            yield from super().iter_solutions()
+            return
+
+        M = self.N**2
+        units = sudoku_units(self.N)
+
+        if len(self.givens) > 0:
+            yield from iter_sudoku_solutions(self.N, units, self.givens)
+            return
+
+        first_row = {pos: pos + 1 for pos in range(M)}
+
+        for solution in iter_sudoku_solutions(self.N, units, first_row):
+            for labels in itertools.permutations(range(1, M + 1)):
+                yield {pos: labels[value - 1] for pos, value in solution.items()}
+
+    def solve_parallel(self, n_workers: Optional[int] = None):
+        if not self.uses_kernel():
+            return super().solve_parallel(n_workers)
+
+        M = self.N**2
+        units = sudoku_units(self.N)
+
+        empty = [pos for pos in range(M**2) if pos not in self.givens]
+        if len(empty) == 0:
+            return self.solve()
+
+        def candidates(pos: int):
+            peers = {
+                value
+                for p, value in self.givens.items()
+                if any(a == b for a, b in zip(units[p], units[pos]))
+            }
+            return [value for value in range(1, M + 1) if value not in peers]
+
+        pos = min(empty, key=lambda p: len(candidates(p)))
+
+        solutions = run_branches(
+            multiprocessing.get_context(),
+            backtrack_sudoku,
+            [
+                (self.N, units, {**self.givens, pos: value}, self.max_solutions)
+                for value in candidates(pos)
+            ],
+            self.max_solutions,
+            n_workers,
+        )
+
+        self.solutions = solutions[: self.max_solutions]
+
+        return len(self.solutions) >= self.max_solutions
+
+    def solve_portfolio(
+        self, timeout: Optional[float] = None, *, n_strategies: Optional[int] = None
+    ):
+        if not self.uses_kernel():
+            return super().solve_portfolio(timeout)
+
+        n_strategies = n_strategies or os.cpu_count() or 1
+        seeds = [None, *range(1, n_strategies)]
+
+        context = multiprocessing.get_context()
+        results = context.Queue()
+
+        workers = [
+            context.Process(
+                target=_solve_sudoku_strategy,
+                args=(results, self.N, self.givens, self.max_solutions, seed),
+                daemon=True,
+            )
+            for seed in seeds
+        ]
+
+        for worker in workers:
+            worker.start()
+
+        deadline = None if timeout is None else time.monotonic() + timeout
+
+        try:
+            self.solutions = wait_for_result(results, workers, deadline)
+        except queue.Empty:
+            self.solutions = []
+        finally:
+            for worker in workers:
+                worker.terminate()
+            for worker in workers:
+                worker.join()
+
+        return len(self.solutions) >= self.max_solutions
+
+
+def _solve_sudoku_strategy(
+    results: multiprocessing.Queue,
+    N: int,
+    givens: Dict[int, int],
+    max_solutions: int,
+    seed: Optional[int],
+):
+    try:
+        solutions = backtrack_sudoku(N, sudoku_units(N), givens, max_solutions, seed)
+    except Exception as e:
+        results.put(e)
+        return
+
+    results.put(solutions)
+
+
 def solution_to_array(solution: dict):
     L = len(solution)
     M = int(math.sqrt(L))
-    grid = np.zeros((L), dtype=int)
+    grid = np.zeros((L), dtype=np.int8)
 
-    for pos, value in solution.items():
-        grid[int(pos)] = value
+    positions = np.fromiter(map(int, solution.keys()), dtype=np.intp, count=L)
+    grid[positions] = np.fromiter(map(int, solution.values()), dtype=np.int8, count=L)
 
     return grid.reshape((M, M))
 
 
+def board_from_string(board: str) -> Dict[str, int]:
+    cells = "".join(board.split())
+    return {str(i): 0 if c == "." else int(c, 36) for i, c in enumerate(cells)}
+
+
+def _as_int(value: Any) -> int:
+    try:
+        number = int(value)
+    except (TypeError, ValueError):
+        raise ValueError(f"Clue {value!r} is not an integer") from None
+
+    if number != value and str(number) != value:
+        raise ValueError(f"Clue {value!r} is not an integer")
+
+    return number
+
+
 def create_sudoku_csp(N: int, values: Dict[int, int], max_solutions: int = 1):
-    M = N ** 2
+    M = N**2
 
-    grid = np.arange(M ** 2)
-    grid = grid.astype(str)
+    grid = np.arange(M**2)
 
-    domain = list(range(1, M + 1))
-    csp = CSP(
+    domain = sudoku_domain(M)
+    csp = SudokuCSP(
+        N=N,
         pruning_type=PruningType.FORWARD_CHECKING,
         variable_ordering=VariableOrdering.FAIL_FIRST,
         max_solutions=max_solutions,
     )
-    csp.add_variables(domain, *grid)
+    csp.add_variables(domain, *grid.tolist())
 
-    for pos, value in values.items():
-        if value != 0:
-            csp.add_constraint(equals_constraint(grid[int(pos)], value))
+    clues = ((_as_int(pos), _as_int(value)) for pos, value in values.items())
+    csp.givens = {pos: value for pos, value in clues if value != 0}
 
-    grid = grid.reshape((M, M))
+    units = sudoku_units(N)
+    rows, cols, boxes = [0] * M, [0] * M, [0] * M
 
-    for row in grid:
-        csp.add_constraint(all_different_constraint(*row))
+    for pos, value in csp.givens.items():
+        if not 0 <= pos < M**2 or not 1 <= value <= M:
+            raise ValueError(f"Clue {value} at {pos} is out of range")
 
-    for column in grid.T:
-        csp.add_constraint(all_different_constraint(*column))
+        r, c, b = units[pos]
+        bit = 1 << (value - 1)
 
-    for i in range(N):
-        for j in range(N):
-            x = slice(i * N, (i + 1) * N)
-            y = slice(j * N, (j + 1) * N)
+        if (rows[r] | cols[c] | boxes[b]) & bit:
+            raise ValueError(f"Clue {value} at {pos} conflicts with another clue")
 
-            subgrid = grid[x, y]
-            csp.add_constraint(all_different_constraint(*subgrid.flatten()))
+        rows[r] |= bit
+        cols[c] |= bit
+        boxes[b] |= bit
 
-    return csp
+    for pos, value in csp.givens.items():
+        csp.set_value(pos, value)
+
+    csp.add_alldiff_batch(sudoku_groups(N))
 
+    return csp
 
-def create_random_board(N: int, difficulty: SudokuDifficulty = SudokuDifficulty.EASY):
-    L = N ** 4
 
+@functools.lru_cache(maxsize=None)
+def load_solution_boards(N: int) -> Tuple[Mapping[str, int], ...]:
     solution_dir = DIR_PATH.joinpath("data/sudoku_solutions")
 
     if not solution_dir.exists():
         raise FileNotFoundError(f"Dir {DIR_PATH} was invalid")
 
-    solutions = list(solution_dir.joinpath(f"{N}").glob("*"))
-    solution_filepath: pathlib.Path = random.choice(solutions)
+    boards = []
+
+    for solution_filepath in sorted(solution_dir.joinpath(f"{N}").glob("*")):
+        board = json.loads(solution_filepath.read_text())
+        boards.append(MappingProxyType({k: int(v) for k, v in board.items()}))
 
-    board = json.loads(solution_filepath.read_text())
+    return tuple(boards)
+
+
+def create_random_board(
+    N: int,
+    difficulty: SudokuDifficulty = SudokuDifficulty.EASY,
+    rng: Optional[random.Random] = None,
+):
+    rng = random if rng is None else rng
+    L = N**4
+
+    board = dict(rng.choice(load_solution_boards(N)))
 
     remove_count = 0
 
@@ -102,24 +467,47 @@ def create_random_board(N: int, difficulty: SudokuDifficulty = SudokuDifficulty.
     elif difficulty == SudokuDifficulty.HARD:
         remove_count = int(L / 1.25)
 
-    keys = list(board.keys())
+    if remove_count == 0:
+        return board
+
+    filled = [key for key, value in board.items() if value != 0]
 
-    for _ in range(remove_count):
-        key = random.choice([i for i in keys if board[i] != 0])
+    for key in rng.sample(filled, remove_count):
         board[key] = 0
 
     return board
 
 
+def _create_random_board_seeded(N: int, difficulty: SudokuDifficulty, seed: int):
+    return create_random_board(N=N, difficulty=difficulty, rng=random.Random(seed))
+
+
+def create_random_boards(
+    N: int,
+    count: int,
+    difficulty: SudokuDifficulty = SudokuDifficulty.EASY,
+    n_workers: Optional[int] = None,
+) -> List[Dict[str, int]]:
+    seeds = [random.getrandbits(64) for _ in range(count)]
+
+    n_workers = n_workers or os.cpu_count() or 1
+    chunksize = max(1, count // (4 * n_workers))
+
+    generate = functools.partial(_create_random_board_seeded, N, difficulty)
+
+    with ProcessPoolExecutor(max_workers=n_workers) as executor:
+        return list(executor.map(generate, seeds, chunksize=chunksize))
+
+
 if __name__ == "__main__":
     N = 3
-    M = N ** 2
+    M = N**2
     solution_dir = DIR_PATH.joinpath("data/sudoku_solutions/").joinpath(f"{N}")
 
     if not solution_dir.exists():
         os.makedirs(solution_dir)
 
-    random_pos = random.randint(0, M ** 2 - 1)
+    random_pos = random.randint(0, M**2 - 1)
     random_value = random.randint(1, 9)
 
     values = {random_pos: random_value}